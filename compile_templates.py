@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+import os
+
+from jinja2 import Environment, FileSystemLoader
+from loguru import logger
+
+TEMPLATES_DIR = os.path.dirname(os.path.abspath(__file__))
+COMPILED_TEMPLATES_DIR = os.path.join(TEMPLATES_DIR, "compiled")
+
+
+def compile_templates():
+    env = Environment(loader=FileSystemLoader(TEMPLATES_DIR), autoescape=True)
+    env.compile_templates(
+        COMPILED_TEMPLATES_DIR,
+        zip=None,
+        filter_func=lambda name: name == "ossec.jinja2",
+        ignore_errors=False,
+    )
+    logger.info(f"Templates have been compiled to {COMPILED_TEMPLATES_DIR}")
+
+
+if __name__ == "__main__":
+    compile_templates()
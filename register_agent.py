@@ -1,167 +1,301 @@
 #!/usr/bin/env python3
 
-import json
+import asyncio
+import base64
+import email.utils
+import glob
 import os
 import sys
-from subprocess import PIPE, Popen  # nosec
+import time
+from http import HTTPStatus
+from subprocess import PIPE, Popen, run  # nosec
 
+import aiohttp
+import orjson
 import psutil
-import urllib3
-from base64 import b64encode
 from healthcheck import HealthCheck
-from jinja2 import Template
+from jinja2 import (
+    ChoiceLoader,
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    ModuleLoader,
+)
+from aiohttp import web
 from loguru import logger
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import time
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-try:
-    import requests
-except ModuleNotFoundError as e:
-    logger.error("No module 'requests' found. Install: pip install requests")
-    sys.exit(1)
 
 health = HealthCheck()
 
-
-class RequestHandler(BaseHTTPRequestHandler):
-    def log_message(self, format, *args):
-        pass
-
-    def do_GET(self):
-        message, status_code, headers = health.run()
-        try:
-            request_path = str(self.path).replace("\n", " ")
-            response_msg = http_codes_serializer(
-                response=json.loads(message), status_code=status_code
-            )
-            logger.info(
-                f"GET request. path: {request_path} headers: {headers}, response: {response_msg}"
-            )
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(bytes(message, encoding="utf8"))
-        except TypeError:
-            self.send_response(500)
+_STATUS_DESC = {status.value: status.name.lower() for status in HTTPStatus}
+
+TEMPLATES_DIR = os.path.dirname(os.path.abspath(__file__))
+COMPILED_TEMPLATES_DIR = os.path.join(TEMPLATES_DIR, "compiled")
+JINJA_CACHE_DIR = "/tmp/jcache"  # nosec
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+ENV = Environment(
+    loader=ChoiceLoader(
+        [ModuleLoader(COMPILED_TEMPLATES_DIR), FileSystemLoader(TEMPLATES_DIR)]
+    ),
+    autoescape=True,
+    bytecode_cache=FileSystemBytecodeCache(JINJA_CACHE_DIR),
+)
+
+SESSION = None
+GROUPS_SEMAPHORE = None
+TOKEN_LOCK = None
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.2
+RETRY_STATUS_FORCELIST = (502, 503, 504)
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=60, connect=10)
+HEALTH_CACHE_MAX_AGE = 5
+WAZUH_AGENTD_PID_GLOB = "/var/ossec/var/run/wazuh-agentd-*.pid"
+TOKEN_FALLBACK_TTL = 300
+TOKEN_EXPIRY_MARGIN = 30
+cached_token = None
+token_expiration = 0
+registered = False
+POLL_INITIAL_DELAY = 1.0
+POLL_MAX_DELAY = 30.0
+GROUP_MAX_RETRIES = 6
+GROUP_MAX_BACKOFF = 300
+
+
+async def health_handler(request):
+    loop = asyncio.get_running_loop()
+    message, status_code, headers = await loop.run_in_executor(None, health.run)
+    try:
+        request_path = request.path_qs.replace("\n", " ")
+        logger.opt(lazy=True).info(
+            "GET request. path: {} headers: {}, response: {}",
+            lambda: request_path,
+            lambda: headers,
+            lambda: http_codes_serializer(
+                response=orjson.loads(message), status_code=status_code
+            ),
+        )
+        if status_code == HTTPStatus.OK:
+            response_headers = {
+                **headers,
+                "Cache-Control": f"public, max-age={HEALTH_CACHE_MAX_AGE}",
+                "Expires": email.utils.formatdate(
+                    time.time() + HEALTH_CACHE_MAX_AGE, usegmt=True
+                ),
+            }
+        else:
+            response_headers = {**headers, "Cache-Control": "no-store"}
+        return web.Response(text=message, status=status_code, headers=response_headers)
+    except TypeError:
+        return web.Response(status=500)
+
+
+async def start_health_server():
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", health_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", 5000)  # nosec
+    await site.start()
+    logger.info("Listening on 0.0.0.0:5000")
+    return runner
 
 
-def json_serialize(record):
-    subset = {"timestamp": record["time"].timestamp(), "message": record["message"]}
-    return json.dumps(subset)
+def http_codes_serializer(response, status_code):
+    msg = orjson.dumps(response, option=orjson.OPT_SORT_KEYS).decode()
+    return f"{msg} status: {status_code} - {code_desc(status_code)}"
 
 
-def get_serialize(message):
-    serialized = json_serialize(message.record)
-    print(serialized)
+def lazy_http_codes_serializer(response, status_code):
+    return lambda: http_codes_serializer(response=response, status_code=status_code)
 
 
-def http_codes_serializer(response, status_code):
-    msg = json.dumps(response, indent=4, sort_keys=True)
-    code = f"status: {status_code} - {code_desc(status_code)}"
-    return f"{json.loads(msg)} {code}"
+def write_file_atomic(path, data):
+    try:
+        with open(path, "rb") as file_:
+            if file_.read() == data:
+                logger.info("{} is unchanged, skipping write", path)
+                return
+    except FileNotFoundError:
+        pass
+    tmp_path = f"{path}.tmp"
+    try:
+        stat = os.stat(path)
+        mode, owner = stat.st_mode & 0o7777, (stat.st_uid, stat.st_gid)
+    except FileNotFoundError:
+        mode, owner = 0o640, None
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        try:
+            if owner:
+                os.fchown(fd, *owner)
+            os.fchmod(fd, mode)
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    dir_fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
 
 
 def create_config_file():
-    logger.info(f"Create Wazuh agent configuration for node {node_name}")
-    with open("ossec.jinja2") as file_:
-        template = Template(file_.read(), autoescape=True)
-        config = template.render(
-            join_manager_hostname=join_manager_worker,
-            join_manager_port=join_manager_port,
-            virus_total_key=virus_total_key,
-        )
-    wazuh_config_file = open("/var/ossec/etc/ossec.conf", "w")
-    wazuh_config_file.write(f"{config} \n")
-    wazuh_config_file.close()
-    open("/var/ossec/etc/local_internal_options.conf", "wb").write(
-        open("local_internal_options.jinja2", "rb").read()
+    logger.info("Create Wazuh agent configuration for node {}", node_name)
+    config = ENV.get_template("ossec.jinja2").render(
+        join_manager_hostname=join_manager_worker,
+        join_manager_port=join_manager_port,
+        virus_total_key=virus_total_key,
     )
+    write_file_atomic("/var/ossec/etc/ossec.conf", f"{config}\n".encode("utf-8"))
+    with open(
+        os.path.join(TEMPLATES_DIR, "local_internal_options.jinja2"), "rb"
+    ) as file_:
+        write_file_atomic("/var/ossec/etc/local_internal_options.conf", file_.read())
     logger.info(
         "Configuration has been generated from template, starting Wazuh agent provisioning"
     )
 
 
-def wazuh_api(method, resource, data=None):
+async def session_request(method, url, **kwargs):
+    for attempt in range(RETRY_TOTAL + 1):
+        try:
+            response = await SESSION.request(method, url, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+            if attempt == RETRY_TOTAL:
+                raise
+            logger.error("Request {} {} failed: {}, retry", method, url, exception)
+        else:
+            if response.status not in RETRY_STATUS_FORCELIST or attempt == RETRY_TOTAL:
+                return response
+            response.release()
+        await asyncio.sleep(RETRY_BACKOFF_FACTOR * (2**attempt))
+
+
+def token_expiry(token):
+    try:
+        payload = orjson.loads(base64.urlsafe_b64decode(token.split(".")[1] + "=="))
+        return payload["exp"] - TOKEN_EXPIRY_MARGIN
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + TOKEN_FALLBACK_TTL
+
+
+async def get_auth_token():
+    global cached_token, token_expiration
+    async with TOKEN_LOCK:
+        if cached_token and time.time() < token_expiration:
+            return cached_token
+        async with await session_request(
+            "get", login_url, headers=login_headers
+        ) as response:
+            content = await response.read()
+        logger.info("Response code {} response content {}", response.status, content)
+        cached_token = orjson.loads(content)["data"]["token"]
+        token_expiration = token_expiry(cached_token)
+        return cached_token
+
+
+async def invalidate_auth_token(token):
+    global cached_token, token_expiration
+    async with TOKEN_LOCK:
+        if cached_token == token:
+            cached_token = None
+            token_expiration = 0
+
+
+async def wazuh_api(method, resource, data=None):
     code = None
     response_json = {}
-    login_headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Basic {b64encode(auth).decode()}",
-    }
-    response = requests.get(login_url, headers=login_headers, verify=False)  # nosec
-    logger.info(
-        f"Response code {response.status_code} response content {response.content}"
-    )
-    token = json.loads(response.content.decode())["data"]["token"]
-    requests_headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token}",
-    }
     url = f"{base_url}/{resource}"
     try:
-        requests.packages.urllib3.disable_warnings()
-
         if method.lower() == "post":
-            response = requests.post(
-                url, headers=requests_headers, data=json.dumps(data), verify=verify
-            )
-        elif method.lower() == "put":
-            response = requests.put(
-                url, headers=requests_headers, data=data, verify=verify
-            )
-        elif method.lower() == "delete":
-            response = requests.delete(
-                url, headers=requests_headers, data=data, verify=verify
-            )
+            request_kwargs = {"json": data}
+        elif method.lower() == "get":
+            request_kwargs = {"params": data}
         else:
-            response = requests.get(
-                url, headers=requests_headers, params=data, verify=verify
-            )
-
-        code = response.status_code
-        response_json = response.json()
+            request_kwargs = {"data": data}
+
+        for attempt in range(2):
+            token = await get_auth_token()
+            requests_headers = {"Authorization": f"Bearer {token}"}
+            async with await session_request(
+                method, url, headers=requests_headers, **request_kwargs
+            ) as response:
+                code = response.status
+                response_json = orjson.loads(await response.read())
+            if code != HTTPStatus.UNAUTHORIZED or attempt:
+                break
+            logger.info("Wazuh API token rejected for resource {}, renewing", resource)
+            await invalidate_auth_token(token)
 
     except Exception as exception:
-        logger.error(f"Error: for resource {resource}, exception {exception}")
+        logger.error("Error: for resource {}, exception {}", resource, exception)
 
     return code, response_json
 
 
-def check_self():
-    process_name = os.path.basename(__file__)
-    for proc in psutil.process_iter():
-        for process in process_name:
-            if process in proc.name():
-                return True, "register_agent ok"
+def check_wazuh_agentd():
+    for pid_file in glob.glob(WAZUH_AGENTD_PID_GLOB):
+        pid = (
+            os.path.basename(pid_file)
+            .removeprefix("wazuh-agentd-")
+            .removesuffix(".pid")
+        )
+        if pid.isdigit() and psutil.pid_exists(int(pid)):
+            return True, "wazuh-agentd ok"
+    return False, "wazuh-agentd is not running"
 
 
-health.add_check(check_self)
+def check_registration():
+    if registered:
+        return True, "agent registration ok"
+    return False, "agent registration is not complete"
 
 
-def code_desc(http_status_code):
-    return requests.status_codes._codes[http_status_code][0]
+health.add_check(check_registration)
+health.add_check(check_wazuh_agentd)
 
 
-def add_agent_to_group(wazuh_agent_id, agent_group):
-    status_code, response = wazuh_api(
-        "put",
-        f"agents/{wazuh_agent_id}/group/{agent_group}?pretty=true&wait_for_complete=true",
-    )
-    response_msg = http_codes_serializer(response=response, status_code=status_code)
+def code_desc(http_status_code):
+    return _STATUS_DESC.get(http_status_code, "unknown")
 
-    if status_code == 200 and response["error"] == 0:
-        logger.info(
-            f"Wazuh agent id {wazuh_agent_id} has been assigned to group {agent_group}. Response {response_msg}"
+
+async def add_agent_to_group(wazuh_agent_id, agent_group):
+    for attempt in range(GROUP_MAX_RETRIES):
+        async with GROUPS_SEMAPHORE:
+            status_code, response = await wazuh_api(
+                "put",
+                f"agents/{wazuh_agent_id}/group/{agent_group}?pretty=true&wait_for_complete=true",
+            )
+        response_msg = lazy_http_codes_serializer(response, status_code)
+
+        if status_code == 200 and response["error"] == 0:
+            logger.opt(lazy=True).info(
+                "Wazuh agent id {} has been assigned to group {}. Response {}",
+                lambda: wazuh_agent_id,
+                lambda: agent_group,
+                response_msg,
+            )
+            return response
+        logger.opt(lazy=True).error(
+            "ERROR: Unable to add agent to group {}", response_msg
         )
-        return response
-    else:
-        logger.error(f"ERROR: Unable to add agent to group {response_msg}, retry")
-        add_agent_to_group(wazuh_agent_id, agent_group)
+        if attempt + 1 < GROUP_MAX_RETRIES:
+            await asyncio.sleep(min(int(wait_time) * (2**attempt), GROUP_MAX_BACKOFF))
+    logger.error(
+        "ERROR: Unable to add agent {} to group {} after {} attempts",
+        wazuh_agent_id,
+        agent_group,
+        GROUP_MAX_RETRIES,
+    )
 
 
-def add_agent(agt_name, agt_ip=None):
+async def add_agent(agt_name, agt_ip=None):
     if agt_ip:
-        status_code, response = wazuh_api(
+        status_code, response = await wazuh_api(
             "post",
             "agents/insert",
             {
@@ -175,7 +309,7 @@ def add_agent(agt_name, agt_ip=None):
             },
         )
     else:
-        status_code, response = wazuh_api(
+        status_code, response = await wazuh_api(
             "post",
             "agents/insert",
             {
@@ -187,41 +321,54 @@ def add_agent(agt_name, agt_ip=None):
                 },
             },
         )
-    response_msg = http_codes_serializer(response=response, status_code=status_code)
+    response_msg = lazy_http_codes_serializer(response, status_code)
     if status_code == 400:
-        logger.error(f"During adding Wazuh agent request return {response_msg}")
+        logger.opt(lazy=True).error(
+            "During adding Wazuh agent request return {}", response_msg
+        )
         pass
     elif status_code == 200 and response["error"] == 0:
         wazuh_agent_id = response["data"]["id"]
         wazuh_agent_key = response["data"]["key"]
-        logger.info(
-            f"Wazuh agent for node '{node_name}' with ID '{wazuh_agent_id}' has been added. Response {response_msg}"
+        logger.opt(lazy=True).info(
+            "Wazuh agent for node '{}' with ID '{}' has been added. Response {}",
+            lambda: node_name,
+            lambda: wazuh_agent_id,
+            response_msg,
         )
         return wazuh_agent_id, wazuh_agent_key
     else:
-        logger.error(f"Unable to add agent {agt_name}: {response_msg}")
+        logger.opt(lazy=True).error(
+            "Unable to add agent {}: {}", lambda: agt_name, response_msg
+        )
 
 
-def wazuh_agent_status(agt_name, pretty=None):
+async def wazuh_agent_status(agt_name, pretty=None):
     wazuh_agnt_name = None
     wazuh_agnt_status = None
+    wazuh_agnt_groups = set()
     if pretty:
-        status_code, response = wazuh_api(
-            "get", f"agents?pretty=true&q=name={agt_name}&wait_for_complete=true"
+        status_code, response = await wazuh_api(
+            "get",
+            f"agents?pretty=true&q=name={agt_name}&select=name,status,group&wait_for_complete=true",
         )
     else:
-        status_code, response = wazuh_api(
-            "get", f"agents?q=name={agt_name}&wait_for_complete=true"
+        status_code, response = await wazuh_api(
+            "get",
+            f"agents?q=name={agt_name}&select=name,status,group&wait_for_complete=true",
         )
-    response_msg = http_codes_serializer(response=response, status_code=status_code)
+    response_msg = lazy_http_codes_serializer(response, status_code)
     if status_code == 200 and response["error"] == 0:
         for items in response["data"]["affected_items"]:
             wazuh_agnt_name = items["name"]
             wazuh_agnt_status = items["status"]
-        logger.info(f"Wazuh agent status: {response_msg}")
-        return wazuh_agnt_name, wazuh_agnt_status
+            wazuh_agnt_groups = set(items.get("group") or [])
+        logger.opt(lazy=True).info("Wazuh agent status: {}", response_msg)
+        return wazuh_agnt_name, wazuh_agnt_status, wazuh_agnt_groups
     else:
-        logger.error(f"Unable to get Wazuh agent status: {response_msg}")
+        logger.opt(lazy=True).error(
+            "Unable to get Wazuh agent status: {}", response_msg
+        )
 
 
 def wazuh_agent_import_key(wazuh_agent_key):
@@ -229,13 +376,22 @@ def wazuh_agent_import_key(wazuh_agent_key):
     std_out, std_err, return_code = execute([cmd, "-i", wazuh_agent_key], "y\n\n")
     if return_code != 0:
         msg = std_err.replace("\n", " ")
-        logger.error(f"Error during importing key: {msg}")
+        logger.error("Error during importing key: {}", msg)
     else:
         msg = std_out.replace("\n", " ")
-        logger.info(f"Key has been imported {msg}")
+        logger.info("Key has been imported {}", msg)
 
 
 def execute(cmd_list, stdin=None):
+    if stdin is None:
+        process = run(
+            cmd_list,
+            capture_output=True,
+            encoding="utf8",
+            check=False,
+            shell=False,  # nosec
+        )
+        return process.stdout, process.stderr, process.returncode
     process = Popen(
         cmd_list,
         stdin=PIPE,
@@ -252,21 +408,74 @@ def execute(cmd_list, stdin=None):
 def restart_wazuh_agent():
     cmd = "/var/ossec/bin/wazuh-control"
     command_stdout, command_stderr, return_code = execute([cmd, "restart"])
-    restarted = False
+    if "Completed." in command_stdout:
+        logger.info("Wazuh agent has been restarted")
+    else:
+        logger.error("error during restarting Wazuh agent: {}", command_stderr)
 
-    for line_output in command_stdout.split(os.linesep):
-        if "Completed." in line_output:
-            restarted = True
-            logger.info("Wazuh agent has been restarted")
-            break
 
-    if not restarted:
-        logger.error(f"error during restarting Wazuh agent: {command_stderr}")
+async def register():
+    global SESSION, GROUPS_SEMAPHORE, TOKEN_LOCK
+    create_config_file()
+    connector = aiohttp.TCPConnector(limit=8, ssl=False, keepalive_timeout=60)  # nosec
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=REQUEST_TIMEOUT,
+        json_serialize=lambda obj: orjson.dumps(obj).decode(),
+    ) as SESSION:
+        GROUPS_SEMAPHORE = asyncio.Semaphore(4)
+        TOKEN_LOCK = asyncio.Lock()
+        agent_id, agent_key = await add_agent(node_name)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, wazuh_agent_import_key, agent_key.encode())
+        await loop.run_in_executor(None, restart_wazuh_agent)
+        status = True
+        delay = POLL_INITIAL_DELAY
+        while status:
+            agent_name, agent_status, agent_groups = await wazuh_agent_status(node_name)
+            if agent_status == "active":
+                logger.info(
+                    "Wazuh agent '{}' is ready and connected,  status - '{}......",
+                    agent_name,
+                    agent_status,
+                )
+                logger.info(
+                    "Wazuh Agent {} has been connected to server {}......",
+                    agent_name,
+                    join_manager_worker,
+                )
+                status = False
+            else:
+                logger.info(
+                    "Waiting for Wazuh agent {} become ready current status is {}......",
+                    agent_name,
+                    agent_status,
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, POLL_MAX_DELAY)
+        if groups == "default":
+            pass
+        else:
+            new_groups = set(groups.split(",")) - agent_groups
+            await asyncio.gather(
+                *[add_agent_to_group(agent_id, group) for group in new_groups]
+            )
+
+
+async def main():
+    global registered
+    runner = await start_health_server()
+    try:
+        await register()
+        registered = True
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
 if __name__ == "__main__":
     logger.remove()
-    logger.add(get_serialize)
+    logger.add(sys.stdout, serialize=True)
     protocol = os.environ.get("JOIN_MANAGER_PROTOCOL", default="https")
     host = os.environ.get(
         "JOIN_MANAGER_MASTER_HOST", default="wazuh.wazuh.svc.cluster.local"
@@ -289,32 +498,8 @@ if __name__ == "__main__":
     base_url = f"{protocol}://{host}:{port}"
     login_url = f"{protocol}://{host}:{port}/{login_endpoint}"
     auth = f"{user}:{password}".encode()
-    verify = False
-    create_config_file()
-    agent_id, agent_key = add_agent(node_name)
-    wazuh_agent_import_key(agent_key.encode())
-    restart_wazuh_agent()
-    status = True
-    while status:
-        agent_name, agent_status = wazuh_agent_status(node_name)
-        if agent_status == "active":
-            logger.info(
-                f"Wazuh agent '{agent_name}' is ready and connected,  status - '{agent_status}......"
-            )
-            logger.info(
-                f"Wazuh Agent {agent_name} has been connected to server {join_manager_worker}......"
-            )
-            status = False
-        else:
-            logger.info(
-                f"Waiting for Wazuh agent {agent_name} become ready current status is {agent_status}......"
-            )
-            time.sleep(int(wait_time))
-    if groups == "default":
-        pass
-    else:
-        for group in list(groups.split(",")):
-            add_agent_to_group(agent_id, group)
-    logger.info("Listening on 0.0.0.0:5000")
-    server = HTTPServer(("0.0.0.0", 5000), RequestHandler)
-    server.serve_forever()
+    login_headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Basic {base64.b64encode(auth).decode()}",
+    }
+    asyncio.run(main())
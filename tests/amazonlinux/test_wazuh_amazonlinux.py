@@ -43,3 +43,10 @@ def test_wazuh_agent_script(host):
     folders = host.file("/var/ossec/register_agent.py")
     assert folders.user == "wazuh"
     assert folders.group == "wazuh"
+
+
+def test_compiled_templates(host):
+    folders = host.file("/var/ossec/compiled")
+    assert folders.is_directory
+    assert folders.user == "wazuh"
+    assert folders.group == "wazuh"